@@ -1,14 +1,34 @@
 from abc import ABC, abstractmethod
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import multiprocessing
+import os
+import numpy as np
 from matplotlib import pyplot as plt
-import seaborn as sns
 
 import pymc as pm
+import pytensor
 import arviz as az
+import xarray as xr
 
+from pymc.model.transform.optimization import freeze_dims_and_data
 from pymc_marketing.mmm.transformers import geometric_adstock, logistic_saturation
 
 
+def _hdi_from_sorted(sorted_samples, hdi_prob):
+    """
+    Narrowest interval holding hdi_prob of the samples, per row of samples already sorted along the last axis
+    """
+    n = sorted_samples.shape[-1]
+    interval_idx_inc = int(np.floor(hdi_prob * n))
+    n_intervals = n - interval_idx_inc
+    widths = sorted_samples[..., interval_idx_inc:] - sorted_samples[..., :n_intervals]
+    lo_idx = widths.argmin(axis=-1)[..., None]
+    lo = np.take_along_axis(sorted_samples, lo_idx, axis=-1)[..., 0]
+    hi = np.take_along_axis(sorted_samples, lo_idx + interval_idx_inc, axis=-1)[..., 0]
+    return np.stack([lo, hi], axis=-1)
+
+
 class MMM():
     def __init__(self, data):
         self.data_raw = data
@@ -16,8 +36,13 @@ class MMM():
         self.channelnames: str # must be set in subclass   
         self.salesname = 'sales'
         self.datename = 'date'
-        self.dates = self.data_raw[self.datename]
+        self.dates = self.data_raw[self.datename].values.astype("datetime64[ns]")
         self.model: pm.Model = None
+        # nutpie and numpyro are faster but not project dependencies, opt in with fit(sampler=...)
+        self.nuts_sampler = "pymc"
+        # numba is only an optional extra of pytensor, fall back to the default mode without it
+        self.compile_mode = "NUMBA" if importlib.util.find_spec("numba") is not None else None
+        self._compiled_model = None # (model, nutpie compiled model)
 
     def define_model(self):
         """
@@ -25,42 +50,116 @@ class MMM():
         """
         raise NotImplementedError("Subclass must implement abstract method 'define_model()")
 
-
-    def fit(self, progressbar=True):
+    def _scale_data(self, columns):
+        """
+        Scale the given columns and sales by their medians, all columns in one vectorized pass
+        """
+        # only the columns the models use, as contiguous float64 arrays, no copy of the DataFrame
+        raw_channels = np.ascontiguousarray(self.data_raw[columns].values, dtype=np.float64)
+        medians = np.nanmedian(raw_channels, axis=0)
+        self.channelscale = dict(zip(columns, medians))
+        self._scaled_channels = raw_channels / medians
+
+        sales = self.data_raw[self.salesname].values.astype(np.float64)
+        self.salesscale = np.nanmedian(sales)
+        self._scaled = {self.salesname: sales / self.salesscale}
+
+    def __getstate__(self):
+        # the compiled nutpie model is per process and does not pickle
+        state = self.__dict__.copy()
+        state['_compiled_model'] = None
+        return state
+
+    def _compile_kwargs(self):
+        return {"mode": self.compile_mode} if self.compile_mode else {}
+
+    def _compile_nutpie(self):
+        import nutpie
+        # compiling is the slow part, so reuse it as long as the model is the same object,
+        # holding on to the model so its id cannot be reused by a redefined one
+        if self._compiled_model is None or self._compiled_model[0] is not self.model:
+            self._compiled_model = (self.model, nutpie.compile_pymc_model(self.model, backend="numba"))
+        return self._compiled_model[1]
+
+    def fit(self, progressbar=True, sampler=None, cores=None):
         """
-        Fit the model
+        Fit the model, sampler is one of 'nutpie', 'numpyro' or 'pymc' (default self.nuts_sampler)
         """
+        sampler = sampler or self.nuts_sampler
         if self.model is None:
-            self.define_model()        
-        with self.model:
-            self.idata = pm.sample(progressbar=progressbar)
+            self.define_model()
+
+        if sampler == "nutpie":
+            import nutpie
+            self.idata = nutpie.sample(self._compile_nutpie(), chains=4, cores=cores, progress_bar=progressbar)
+        elif sampler == "numpyro":
+            with self.model:
+                # one jitted kernel vmapped over the chains
+                self.idata = pm.sample(progressbar=progressbar, cores=cores, chains=4, nuts_sampler="numpyro",
+                                       nuts_sampler_kwargs={"chain_method": "vectorized"})
+        else:
+            # pm.sample has no compile_kwargs in the pinned pymc, the mode is picked up from the config
+            with pytensor.config.change_flags(**self._compile_kwargs()), self.model:
+                self.idata = pm.sample(progressbar=progressbar, cores=cores, chains=4)
+
+
+    @property
+    def _backscale_factors(self):
+        """
+        Factors taking fitted parameters back to the units of the raw data, set in subclass
+        """
+        return {}
 
+    def get_back_scaled_idata(self):
+        """
+        Posterior of the fitted parameters in the units of the raw data, without copying the rest of idata
+        """
+        # copy only the fitted parameters, not the deterministics
+        posterior = self.idata.posterior[self.fittedparmnames].copy()
+        for name, factor in self._backscale_factors.items():
+            posterior[name] = posterior[name] * factor
+        return az.InferenceData(posterior=posterior)
+
+    def compute_mu_channels(self, idata=None):
+        """
+        Expected value from channels per draw, reconstructed from the posterior (default self.idata)
+        """
+        raise NotImplementedError("Subclass must implement abstract method 'compute_mu_channels()")
+
+    def _spend_dataarray(self, column):
+        """
+        Scaled spend column as a DataArray over dates
+        """
+        return xr.DataArray(self._scaled_channels[:, column], dims=self.datename, coords={self.datename: self.dates})
 
     def plot_posterior_predictive(self, plot_kwargs=None):
         """
         Plot the posterior predictive of sales
         """
-        with self.model:
-            pp = pm.sample_posterior_predictive(self.idata, var_names=["mu_y"])
-        
-        plotdata = { 
-            "date" : self.dates }
+        # the draws are stored on self.idata, so later calls reuse them
+        if "posterior_predictive" not in self.idata or "mu_y" not in self.idata.posterior_predictive:
+            with self.model:
+                pp = pm.sample_posterior_predictive(self.idata, var_names=["mu_y"], predictions=False,
+                                                    compile_kwargs=self._compile_kwargs())
+            # extend() skips groups that already exist, e.g. from a user PPC on y, so merge mu_y in
+            if "posterior_predictive" in self.idata:
+                self.idata.posterior_predictive["mu_y"] = pp.posterior_predictive["mu_y"]
+            else:
+                self.idata.add_groups(posterior_predictive=pp.posterior_predictive)
+        pp = self.idata.posterior_predictive
 
-        extract_vars = ["mu_y"]
-        for plotvar in extract_vars:
-            plotdata[plotvar] = pp.posterior_predictive[plotvar].mean(dim=["chain", "draw"])
+        mu_y_values = pp["mu_y"].mean(dim=["chain", "draw"]).values
 
-        plotdata_df = pd.DataFrame(data=plotdata)
         fig, ax = plt.subplots()
         fig.set_size_inches(12, 6)
-        sns.lineplot(x="date", y="sales", color="black", data=self.data_scaled, ax=ax)
+        ax.plot(self.dates, self._scaled[self.salesname], color="black")
         ax.set(title="Sales (Target Variable)", xlabel="date", ylabel="y (scaled)");
-        sns.lineplot(x="date", y="mu_y", color="blue", data=plotdata_df, ax=ax)  
+        ax.plot(self.dates, mu_y_values, color="blue")
 
+        # one sort over the draws serves all HDI levels
+        sorted_samples = np.sort(pp["mu_y"].stack(sample=("chain", "draw")).transpose(..., "sample").values, axis=-1)
         for hdi_prob, alpha in zip((0.94, 0.50), (0.2, 0.4), strict=True):
-            likelihood_hdi: DataArray = az.hdi(
-                ary=pp.posterior_predictive, hdi_prob=hdi_prob
-            )["mu_y"]
+            likelihood_hdi = _hdi_from_sorted(sorted_samples, hdi_prob)
 
             ax.fill_between(
                 x=self.dates,
@@ -72,9 +171,11 @@ class MMM():
             )
 
     def plot_parm_dist(self):
+        """
+        Plot the posterior of the fitted parameters, back scaled to the units of the raw data
+        """
         az.plot_posterior(
-            self.idata,
-            var_names=self.fittedparmnames,
+            self.get_back_scaled_idata(),
             figsize=(12, 6),
         )
         plt.tight_layout();
@@ -83,7 +184,8 @@ class MMM():
 
 class MMMChannelsStraight(MMM):
     def __init__(self, data, channelnames, allowIntercept: bool = False, 
-                 allowAdstockAndSat: bool = False, adstock_max_lag: int = 6):
+                 allowAdstockAndSat: bool = False, adstock_max_lag: int = 6,
+                 keep_deterministics: bool = False):
         super().__init__(data)
         self.modelname = 'google_fb_straight'
         self.channelnames = channelnames
@@ -92,19 +194,40 @@ class MMMChannelsStraight(MMM):
         self.allowIntercept = allowIntercept
         self.allowAdstockAndSat = allowAdstockAndSat
         self.adstock_max_lag = adstock_max_lag
+        self.keep_deterministics = keep_deterministics
   
     def set_scaling(self):
         """
         Set the scaling of the channels and sales to get more normalized data
         """
-        self.data_scaled = self.data_raw.copy()
-        self.channelscale = {}
-        for channel in self.channelnames:
-            self.channelscale[channel] = self.data_scaled[channel].median()
-            self.data_scaled[channel] = self.data_scaled[channel] / self.channelscale[channel]
-        
-        self.salesscale = self.data_scaled[self.salesname].median()
-        self.data_scaled[self.salesname] = self.data_scaled[self.salesname] / self.salesscale
+        self._scale_data(self.channelnames)
+
+    @property
+    def _backscale_factors(self):
+        factors = {'sigma': self.salesscale}
+        if self.allowIntercept:
+            factors['intercept'] = self.salesscale
+        if self.allowAdstockAndSat:
+            # beta multiplies the saturated channels which have no units
+            factors['beta'] = self.salesscale
+        else:
+            factors['beta'] = xr.DataArray([self.salesscale / self.channelscale[channel] for channel in self.channelnames],
+                                           dims="channels", coords={"channels": self.channelnames})
+        return factors
+
+    def compute_mu_channels(self, idata=None):
+        posterior = (self.idata if idata is None else idata).posterior
+        spend = xr.DataArray(self._scaled_channels, dims=(self.datename, "channels"),
+                             coords={self.datename: self.dates, "channels": self.channelnames})
+        if self.allowAdstockAndSat:
+            # same normalized geometric adstock and logistic saturation as in the model
+            lags = xr.DataArray(np.arange(self.adstock_max_lag), dims="lag")
+            weights = posterior['alpha'] ** lags
+            weights = weights / weights.sum("lag")
+            spend_lagged = xr.concat([spend.shift({self.datename: lag}, fill_value=0) for lag in range(self.adstock_max_lag)], dim="lag")
+            channel_adstock = xr.dot(spend_lagged, weights, dim="lag")
+            spend = (1 - np.exp(-posterior['lam'] * channel_adstock)) / (1 + np.exp(-posterior['lam'] * channel_adstock))
+        return xr.dot(spend, posterior['beta'], dim="channels").transpose("chain", "draw", self.datename)
 
     def define_model(self):
         """
@@ -114,7 +237,7 @@ class MMMChannelsStraight(MMM):
         
         with pm.Model(coords=coords) as self.model:
             # variables
-            spend = pm.Data('spend', self.data_scaled[self.channelnames].values, dims=(self.datename, "channels"))
+            spend = pm.Data('spend', self._scaled_channels, dims=(self.datename, "channels"))
 
             # Priors
             if self.allowIntercept:
@@ -124,10 +247,10 @@ class MMMChannelsStraight(MMM):
             else:
                 intercept = 0
 
-            sigma = pm.HalfNormal('sigma')
+            sigma = pm.HalfNormal('sigma', sigma=1.0)
 
-            # channel effects
-            beta = pm.Normal('beta', mu=1, sigma=1, dims=("channels"))
+            # channel effects, positive lift per unit of scaled spend
+            beta = pm.LogNormal('beta', mu=0, sigma=0.5, dims=("channels"))
 
             # adstock and saturation?
             if self.allowAdstockAndSat:
@@ -137,35 +260,33 @@ class MMMChannelsStraight(MMM):
                 lam = pm.Gamma('lam', alpha=3, beta=1, dims=("channels"))                
                 self.fittedparmnames = self.fittedparmnames + ['lam']
 
-                channel_adstock = pm.Deterministic(
-                    name="channel_adstock",
-                    var=geometric_adstock(
-                        x=spend,
-                        alpha=alpha,
-                        l_max=self.adstock_max_lag,
-                        normalize=True,
-                        axis=0,
-                    ),
-                    dims=("date", "channels"),
+                channel_adstock = geometric_adstock(
+                    x=spend,
+                    alpha=alpha,
+                    l_max=self.adstock_max_lag,
+                    normalize=True,
+                    axis=0,
                 )
-
-                channel_adstock_saturated = pm.Deterministic(
-                    name="channel_adstock_saturated",
-                    var=logistic_saturation(x=channel_adstock, lam=lam),
-                    dims=("date", "channels"),
-                )
-                # Expected value from channels
-                mu_channels = pm.Deterministic('mu_channels', pm.math.dot(channel_adstock_saturated, beta), dims=(self.datename))
+                channel_adstock_saturated = logistic_saturation(x=channel_adstock, lam=lam)
+                # only store the (date, channels) intermediates in the trace when asked for
+                if self.keep_deterministics:
+                    pm.Deterministic("channel_adstock", channel_adstock, dims=("date", "channels"))
+                    pm.Deterministic("channel_adstock_saturated", channel_adstock_saturated, dims=("date", "channels"))
+                # Expected value from channels, elementwise so adstock, saturation and the sum fuse
+                mu_channels = pm.math.sum(channel_adstock_saturated * beta, axis=-1)
             else:
                 # Expected value from channels
-                mu_channels = pm.Deterministic('mu_channels', pm.math.dot(spend, beta), dims=(self.datename))
+                mu_channels = pm.math.dot(spend, beta)
 
             # Expected value
             mu_y = pm.Deterministic('mu_y', intercept + mu_channels, dims=(self.datename))
 
 
             # Likelihood
-            y = pm.Normal('y', mu=mu_y, sigma=sigma, observed=self.data_scaled[self.salesname].values, dims=(self.datename))
+            y = pm.Normal('y', mu=mu_y, sigma=sigma, observed=self._scaled[self.salesname], dims=(self.datename))
+
+        # freezing dims and data turns shapes into compile-time constants
+        self.model = freeze_dims_and_data(self.model)
 
 
 
@@ -185,14 +306,26 @@ class MMMChannelsStraightConfounder(MMM):
         """
         Set the scaling of the channels and sales to get more normalized data
         """
-        self.data_scaled = self.data_raw.copy()
-        self.channelscale = {}
-        for channel in self.channelnames:
-            self.channelscale[channel] = self.data_scaled[channel].median()
-            self.data_scaled[channel] = self.data_scaled[channel] / self.channelscale[channel]
-        
-        self.salesscale = self.data_scaled[self.salesname].median()
-        self.data_scaled[self.salesname] = self.data_scaled[self.salesname] / self.salesscale
+        self._scale_data(self.channelnames)
+
+    @property
+    def _backscale_factors(self):
+        return {
+            'beta_fb': self.salesscale / self.channelscale['spend_fb'],
+            'beta_google': self.salesscale / self.channelscale['spend_google'],
+            'beta_fb_google': self.channelscale['spend_google'] / self.channelscale['spend_fb'],
+            'spend_google_0': self.channelscale['spend_google'],
+            'sigma_google': self.channelscale['spend_google'],
+            'intercept': self.salesscale,
+            'sigma': self.salesscale,
+        }
+
+    def compute_mu_channels(self, idata=None):
+        posterior = (self.idata if idata is None else idata).posterior
+        spend_fb = self._spend_dataarray(self.channelnames.index('spend_fb'))
+        spend_google = self._spend_dataarray(self.channelnames.index('spend_google'))
+        mu_channels = posterior['intercept'] + posterior['beta_fb'] * spend_fb + posterior['beta_google'] * spend_google
+        return mu_channels.transpose("chain", "draw", self.datename)
 
     def define_model(self):
         """
@@ -204,47 +337,53 @@ class MMMChannelsStraightConfounder(MMM):
             # self.fittedparmnames = ['beta_fb', 'beta_google', 'beta_fb_google', 'sigma']
             self.fittedparmnames = ['beta_fb', 'beta_google', 'beta_fb_google', 'spend_google_0', 'sigma', 'intercept', 'sigma_google']
             # variables
-            spend_fb = pm.Data('spend_fb', self.data_scaled['spend_fb'].values, dims=(self.datename))
+            spend_fb = pm.Data('spend_fb', self._scaled_channels[:, self.channelnames.index('spend_fb')], dims=(self.datename))
 
-            sigma = pm.HalfNormal('sigma')
+            sigma = pm.HalfNormal('sigma', sigma=1.0)
 
             # intercept
             intercept = pm.Normal('intercept', mu=1, sigma=1)
 
             # channel effects
-            beta_fb = pm.Normal('beta_fb', mu=1, sigma=1)
-            beta_google = pm.Normal('beta_google', mu=1, sigma=1)
+            beta_fb = pm.LogNormal('beta_fb', mu=0, sigma=0.5)
+            beta_google = pm.LogNormal('beta_google', mu=0, sigma=0.5)
 
-            # fb contribution
-            mu_fb = pm.Deterministic('mu_fb', beta_fb*spend_fb, dims=(self.datename))
+            # fb contribution, intermediates are plain tensors, only mu_y goes in the trace
+            mu_fb = beta_fb*spend_fb
 
             # google contribution
             beta_fb_google = pm.Normal('beta_fb_google', mu=1, sigma=1)
             spend_google_0 = pm.Normal('spend_google_0', mu=1, sigma=1)
-            spend_google_fb = pm.Deterministic('spend_google_fb', spend_fb * beta_fb_google, dims=(self.datename))
+            spend_google_fb = spend_fb * beta_fb_google
 
-            sigma_google = pm.HalfNormal('sigma_google')
+            sigma_google = pm.HalfNormal('sigma_google', sigma=1.0)
 
             spend_google = pm.Normal('spend_google', mu=spend_google_0 + spend_google_fb, sigma=sigma_google, dims=(self.datename), 
-                                            observed=self.data_scaled['spend_google'].values)
+                                            observed=self._scaled_channels[:, self.channelnames.index('spend_google')])
 
-            mu_google = pm.Deterministic('mu_google', beta_google*spend_google, dims=(self.datename))
+            mu_google = beta_google*spend_google
 
 
-            mu_channels = pm.Deterministic('mu_channels', intercept + mu_fb + mu_google, dims=(self.datename))
+            mu_channels = intercept + mu_fb + mu_google
 
             # Expected value
             mu_y = pm.Deterministic('mu_y', intercept + mu_channels, dims=(self.datename))
 
 
             # Likelihood
-            y = pm.Normal('y', mu=mu_y, sigma=sigma, observed=self.data_scaled[self.salesname].values, dims=(self.datename))
+            y = pm.Normal('y', mu=mu_y, sigma=sigma, observed=self._scaled[self.salesname], dims=(self.datename))
+
+        # freezing dims and data turns shapes into compile-time constants
+        self.model = freeze_dims_and_data(self.model)
 
 
 
 
 
 class MMMFbGoogleMetrics(MMM):
+    # nutpie compiled model per set of dates, shared by all metric choices, each instance swaps in its data
+    _nutpie_compiled = {}
+
     def __init__(self, data, fb_metric = "clicks_fb", google_metric = "clicks_google"):
         super().__init__(data)
         self.modelname = 'google_fb_straight'
@@ -257,15 +396,30 @@ class MMMFbGoogleMetrics(MMM):
         """
         Set the scaling of the channels and sales to get more normalized data
         """
-        self.data_scaled = self.data_raw.copy()
-        self.channelscale = {}
-
-        for metric in [self.fb_metric, self.google_metric]:
-            self.channelscale[metric] = self.data_scaled[metric].median()
-            self.data_scaled[metric] = self.data_scaled[metric] / self.channelscale[metric]
-        
-        self.salesscale = self.data_scaled[self.salesname].median()
-        self.data_scaled[self.salesname] = self.data_scaled[self.salesname] / self.salesscale
+        self._scale_data([self.fb_metric, self.google_metric])
+
+    @property
+    def _backscale_factors(self):
+        return {
+            'beta_fb': self.salesscale / self.channelscale[self.fb_metric],
+            'beta_google': self.salesscale / self.channelscale[self.google_metric],
+            'intercept': self.salesscale,
+            'sigma': self.salesscale,
+        }
+
+    def _compile_nutpie(self):
+        import nutpie
+        # the graph is the same for every metric choice, only the data differs
+        key = self.dates.tobytes()
+        if key not in MMMFbGoogleMetrics._nutpie_compiled:
+            MMMFbGoogleMetrics._nutpie_compiled[key] = nutpie.compile_pymc_model(self.model, backend="numba")
+        return MMMFbGoogleMetrics._nutpie_compiled[key].with_data(
+            fb_in=self._scaled_channels[:, 0], google_in=self._scaled_channels[:, 1], sales_in=self._scaled[self.salesname])
+
+    def compute_mu_channels(self, idata=None):
+        posterior = (self.idata if idata is None else idata).posterior
+        mu_channels = posterior['beta_fb'] * self._spend_dataarray(0) + posterior['beta_google'] * self._spend_dataarray(1)
+        return mu_channels.transpose("chain", "draw", self.datename)
 
 
     def define_model(self):
@@ -275,27 +429,48 @@ class MMMFbGoogleMetrics(MMM):
         coords = { self.datename: self.dates }
 
         with pm.Model(coords=coords) as self.model:
-            # variables
-            fb_in = pm.Data('fb_in', self.data_scaled[self.fb_metric].values, dims=(self.datename))
-            google_in = pm.Data('google_in', self.data_scaled[self.google_metric].values, dims=(self.datename))
+            # variables, mutable so a shared nutpie compile can take this instance's data
+            fb_in = pm.Data('fb_in', self._scaled_channels[:, 0], dims=(self.datename), mutable=True)
+            google_in = pm.Data('google_in', self._scaled_channels[:, 1], dims=(self.datename), mutable=True)
+            sales_in = pm.Data('sales_in', self._scaled[self.salesname], dims=(self.datename), mutable=True)
 
             # Priors
             intercept = pm.Normal('intercept', mu=1, sigma=1)
 
-            sigma = pm.HalfNormal('sigma')
+            sigma = pm.HalfNormal('sigma', sigma=1.0)
 
             # channel effects
-            beta_fb = pm.Normal('beta_fb', mu=1, sigma=1)
-            beta_google = pm.Normal('beta_google', mu=1, sigma=1)
+            beta_fb = pm.LogNormal('beta_fb', mu=0, sigma=0.5)
+            beta_google = pm.LogNormal('beta_google', mu=0, sigma=0.5)
 
-            mu_channels = pm.Deterministic('mu_channels', fb_in*beta_fb + google_in*beta_google, dims=(self.datename))
+            mu_channels = fb_in*beta_fb + google_in*beta_google
 
             # Expected value
             mu_y = pm.Deterministic('mu_y', intercept + mu_channels, dims=(self.datename))
 
 
             # Likelihood
-            y = pm.Normal('y', mu=mu_y, sigma=sigma, observed=self.data_scaled[self.salesname].values, dims=(self.datename))
-
-
-
+            y = pm.Normal('y', mu=mu_y, sigma=sigma, observed=sales_in, dims=(self.datename))
+
+
+def _fit_one(mmm, sampler):
+    # one process per model, so the chains inside it run on a single core
+    mmm.fit(progressbar=False, sampler=sampler, cores=1)
+    return mmm.idata
+
+
+def fit_many(models: list[MMM], n_jobs=None, sampler=None):
+    """
+    Fit independent models in parallel processes, sets and returns the idata of each model
+    """
+    # every worker samples on a single core, so one worker per core
+    n_jobs = n_jobs or os.cpu_count() or 1
+    # spawn rather than fork, forking after JAX or numba started their threads can deadlock
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")) as executor:
+        idatas = list(executor.map(_fit_one, models, [sampler] * len(models)))
+
+    for mmm, idata in zip(models, idatas, strict=True):
+        if mmm.model is None:
+            mmm.define_model()
+        mmm.idata = idata
+    return idatas
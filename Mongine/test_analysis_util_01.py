@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+pd = pytest.importorskip("pandas")
+pm = pytest.importorskip("pymc")
+az = pytest.importorskip("arviz")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("pymc_marketing")
+
+from analysis_util_01 import MMMChannelsStraight, MMMFbGoogleMetrics, _hdi_from_sorted
+
+
+def make_data(n_dates=40, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "date": pd.date_range("2024-01-01", periods=n_dates, freq="D"),
+        "sales": rng.uniform(50, 150, n_dates),
+        "spend_fb": rng.uniform(10, 30, n_dates),
+        "spend_google": rng.uniform(5, 20, n_dates),
+    })
+
+
+def prior_as_posterior(mmm):
+    """
+    Prior draws stand in for a fitted trace, they hold the same variables as the posterior
+    """
+    mmm.define_model()
+    with mmm.model:
+        prior = pm.sample_prior_predictive(50, random_seed=1)
+    return az.InferenceData(posterior=prior.prior)
+
+
+@pytest.mark.parametrize("hdi_prob", [0.94, 0.5])
+def test_hdi_from_sorted_matches_arviz(hdi_prob):
+    rng = np.random.default_rng(2)
+    draws = xr.DataArray(rng.gamma(2.0, size=(4, 250, 30)), dims=("chain", "draw", "date"))
+
+    sorted_samples = np.sort(draws.stack(sample=("chain", "draw")).transpose(..., "sample").values, axis=-1)
+    expected = az.hdi(xr.Dataset({"mu_y": draws}), hdi_prob=hdi_prob)["mu_y"].transpose("date", "hdi").values
+    np.testing.assert_allclose(_hdi_from_sorted(sorted_samples, hdi_prob), expected)
+
+
+@pytest.mark.parametrize("allowAdstockAndSat", [False, True])
+def test_compute_mu_channels_matches_mu_y(allowAdstockAndSat):
+    mmm = MMMChannelsStraight(make_data(), ["spend_fb", "spend_google"], allowIntercept=True,
+                              allowAdstockAndSat=allowAdstockAndSat, adstock_max_lag=4)
+    idata = prior_as_posterior(mmm)
+
+    mu_channels = mmm.compute_mu_channels(idata)
+    expected = idata.posterior["mu_y"] - idata.posterior["intercept"]
+    np.testing.assert_allclose(mu_channels.values, expected.transpose(*mu_channels.dims).values, rtol=1e-6)
+
+
+def test_fb_google_metrics_models_keep_their_own_data():
+    data = make_data()
+    data["clicks_fb"] = np.arange(len(data)) + 1.0
+    data["clicks_google"] = np.arange(len(data))[::-1] + 1.0
+    mmm_spend = MMMFbGoogleMetrics(data, fb_metric="spend_fb", google_metric="spend_google")
+    mmm_clicks = MMMFbGoogleMetrics(data, fb_metric="clicks_fb", google_metric="clicks_google")
+    idata_spend = prior_as_posterior(mmm_spend)
+    prior_as_posterior(mmm_clicks)
+
+    assert mmm_spend.model is not mmm_clicks.model
+    # the first model still computes mu_y from its own metrics after the second is defined
+    with mmm_spend.model:
+        pp = pm.sample_posterior_predictive(az.InferenceData(posterior=idata_spend.posterior), var_names=["mu_y"])
+    mu_channels = mmm_spend.compute_mu_channels(idata_spend)
+    expected = pp.posterior_predictive["mu_y"] - idata_spend.posterior["intercept"]
+    np.testing.assert_allclose(mu_channels.values, expected.transpose(*mu_channels.dims).values, rtol=1e-6)